@@ -18,16 +18,20 @@ import requests
 import threading
 import textwrap
 import readline
-import re
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional
 from datetime import datetime
-from dataclasses import dataclass, asdict
-
+from dataclasses import dataclass, asdict, fields
 
 
+def _json_line(record) -> str:
+    """Serialize one conversation log record as a compact JSON line"""
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
 
 
+def _exchange_line(exchange: Dict) -> str:
+    """Serialize an exchange as a positional array, dropping per-exchange keys"""
+    return _json_line([exchange.get(name) for name in EXCHANGE_FIELDS])
 
 
 @dataclass
@@ -35,6 +39,15 @@ class Exchange:
     timestamp: str
     user: str
     assistant: str
+    tokens: int
+
+
+# Exchanges are logged as positional arrays in this field order. Add new
+# fields at the end: shorter arrays from older logs still load, with missing
+# trailing fields left unset (tokens is re-estimated on load).
+EXCHANGE_FIELDS = tuple(field.name for field in fields(Exchange))
+# Leading fields every exchange array must carry
+EXCHANGE_REQUIRED_FIELDS = EXCHANGE_FIELDS.index("tokens")
 
 
 class TokenEstimator:
@@ -43,160 +56,325 @@ class TokenEstimator:
     def __init__(self):
         # Allow override via env
         self.chars_per_token = float(os.environ.get("MEMAI_CHARS_PER_TOKEN", "3.0"))
+        # An explicit override pins the ratio; otherwise learn it per model
+        self.calibrate_enabled = "MEMAI_CHARS_PER_TOKEN" not in os.environ
+        self.chars_per_token_by_model: Dict[str, float] = {}
         
-    def estimate_tokens(self, text: str) -> int:
+    def estimate_tokens(self, text: str, model: Optional[str] = None) -> int:
         """Conservative estimation - easily tunable"""
         if not text:
             return 0
-        return max(1, int(len(str(text)) / self.chars_per_token))
+        length = len(text) if isinstance(text, str) else len(str(text))
+        chars_per_token = self.chars_per_token_by_model.get(model, self.chars_per_token)
+        return max(1, int(length / chars_per_token))
     
-    def estimate_conversation_tokens(self, exchanges: List[Dict]) -> int:
+    def calibrate(self, model: str, text: str, token_count: Optional[int]):
+        """Blend an observed chars-per-token ratio into the model's moving average"""
+        if not self.calibrate_enabled or not text or not token_count:
+            return
+        observed = len(text) / token_count
+        current = self.chars_per_token_by_model.get(model, self.chars_per_token)
+        self.chars_per_token_by_model[model] = 0.9 * current + 0.1 * observed
+    
+    def estimate_exchange_tokens(self, exchange: Dict, model: Optional[str] = None) -> int:
+        """Estimate tokens for one exchange, caching the count on the exchange"""
+        tokens = exchange.get("tokens")
+        if tokens is None:
+            # Exchanges saved before token caching existed
+            tokens = self.estimate_tokens(exchange.get("user", ""), model) + self.estimate_tokens(exchange.get("assistant", ""), model)
+            exchange["tokens"] = tokens
+        return tokens
+    
+    def estimate_conversation_tokens(self, exchanges: List[Dict], model: Optional[str] = None) -> int:
         """Estimate tokens for a list of conversation exchanges"""
-        total = 0
-        for exchange in exchanges:
-            if 'user' in exchange:
-                total += self.estimate_tokens(exchange['user'])
-            if 'assistant' in exchange:
-                total += self.estimate_tokens(exchange['assistant'])
-        return total
+        return sum(self.estimate_exchange_tokens(exchange, model) for exchange in exchanges)
 
 
 class ProgressDots:
-    """Animated thinking dots with clean termination"""
+    """Animated thinking dots shown while a blocking call runs"""
     
-    def __init__(self):
-        self.stop_event = threading.Event()
-        self.thread = None
+    # Start on a visible frame so replies shorter than one frame still show dots
+    FRAMES = ['.', '..', '...', '']
     
-    def start(self):
-        """Start the animation"""
-        if self.thread and self.thread.is_alive():
-            return
+    def __init__(self, interval: float = 0.5, tick: float = 0.1):
+        self.interval = interval  # time between frames
+        self.tick = tick  # how often to check whether the call finished
+    
+    def run(self, func, *args, **kwargs):
+        """Run func on a worker thread, animating here until it returns"""
+        outcome = {}
         
-        self.stop_event.clear()
-        self.thread = threading.Thread(target=self._animate, daemon=True)
-        self.thread.start()
-    
-    def stop(self):
-        """Stop the animation and clear the line"""
-        if self.stop_event:
-            self.stop_event.set()
-        if self.thread and self.thread.is_alive():
-            self.thread.join(timeout=0.5)
-        # Clear the dots line
-        print('\r' + ' ' * 20 + '\r', end='', flush=True)
-    
-    def _animate(self):
-        """Animation loop"""
-        dots = ['', '.', '..', '...']
-        i = 0
-        while not self.stop_event.is_set():
-            print(f'\r{dots[i % len(dots)]}', end='', flush=True)
-            i += 1
-            time.sleep(0.5)
-    
-    def __enter__(self):
-        self.start()
-        return self
-    
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
+        def target():
+            try:
+                outcome["value"] = func(*args, **kwargs)
+            except BaseException as e:
+                outcome["error"] = e
+        
+        # Daemon so Ctrl+C exits without waiting on a slow request
+        worker = threading.Thread(target=target, daemon=True)
+        worker.start()
+        ticks_per_frame = max(1, round(self.interval / self.tick))
+        try:
+            i = 0
+            while worker.is_alive():
+                if i % ticks_per_frame == 0:
+                    frame = self.FRAMES[(i // ticks_per_frame) % len(self.FRAMES)]
+                    # Pad so shorter frames overwrite longer ones
+                    print(f'\r{frame:<3}', end='', flush=True)
+                i += 1
+                # Wakes as soon as the worker finishes
+                worker.join(self.tick)
+        finally:
+            # Clear the dots line
+            print('\r' + ' ' * 20 + '\r', end='', flush=True)
+        
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome.get("value")
 
 
 class MemoryManager:
     """Per-model conversation memory with token budgeting"""
     
+    # Characters in model names that can't appear in filenames
+    _FILENAME_TABLE = str.maketrans({':': '_', '/': '_'})
+    
     def __init__(self, memory_dir: str = "./memory"):
         self.memory_dir = Path(memory_dir)
         self.memory_dir.mkdir(exist_ok=True)
         self.token_estimator = TokenEstimator()
+        # Loaded conversations by model; mutated in place and written through on save
+        self._cache: Dict[str, Dict] = {}
+        self._path_cache: Dict[str, Path] = {}
     
     def _get_conversation_file(self, model: str) -> Path:
-        """Get conversation file path with collision-safe naming"""
-        # Hash the model name to handle special characters
-        model_hash = hashlib.md5(model.encode()).hexdigest()[:8]
-        safe_name = f"{model.replace(':', '_').replace('/', '_')}_{model_hash}.json"
-        return self.memory_dir / safe_name
+        """Get conversation log path with collision-safe naming"""
+        file_path = self._path_cache.get(model)
+        if file_path is None:
+            # Hash the model name to handle special characters
+            model_hash = hashlib.md5(model.encode()).hexdigest()[:8]
+            safe_name = f"{model.translate(self._FILENAME_TABLE)}_{model_hash}.jsonl"
+            file_path = self._path_cache[model] = self.memory_dir / safe_name
+        return file_path
+    
+    def _file_state(self, model: str) -> Optional[tuple]:
+        """Identify the on-disk log version by (mtime_ns, size)"""
+        try:
+            st = os.stat(self._get_conversation_file(model))
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
     
     def _load_conversation(self, model: str) -> Dict:
-        """Load conversation from file"""
+        """Load conversation from cache, falling back to file"""
+        data = self._cache.get(model)
+        # Reload if another process has written the log since we cached it
+        if data is None or data["file_state"] != self._file_state(model):
+            data = self._read_conversation(model)
+            # Running total kept in step by add_exchange and trimming
+            data["total_tokens"] = self.token_estimator.estimate_conversation_tokens(data["exchanges"], model)
+            data["file_state"] = self._file_state(model)
+            self._cache[model] = data
+        return data
+    
+    def _read_conversation(self, model: str) -> Dict:
+        """Replay conversation log from file.
+        
+        The log is JSON Lines: a {"metadata": ...} header, one array per
+        exchange in EXCHANGE_FIELDS order, and {"trim": n} markers recording
+        that the n oldest exchanges were dropped. Exchange arrays may omit
+        trailing fields; unrecognized records are skipped.
+        """
         file_path = self._get_conversation_file(model)
+        metadata = None
+        exchanges = []
+        start = 0
+        torn = False
         
-        if not file_path.exists():
+        # Open directly instead of exists() + open to save a stat per load
+        try:
+            # Binary so a line cut mid-character fails in json.loads, not in the reader
+            with open(file_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted append (bad JSON or bad UTF-8)
+                        torn = True
+                        continue
+                    if not line.endswith(b'\n'):
+                        # Complete record missing its newline; the next append would join onto it
+                        torn = True
+                    if isinstance(record, list):
+                        if len(record) >= EXCHANGE_REQUIRED_FIELDS:
+                            exchanges.append(dict(zip(EXCHANGE_FIELDS, record)))
+                    elif isinstance(record, dict):
+                        if "trim" in record:
+                            start += record["trim"]
+                        elif "metadata" in record:
+                            metadata = record["metadata"]
+        except FileNotFoundError:
+            return self._migrate_legacy_conversation(model)
+        except IOError:
+            # Unreadable file, start fresh
             return {"exchanges": [], "metadata": {"created": datetime.now().isoformat()}}
         
+        data = {
+            "exchanges": exchanges[start:],
+            "metadata": metadata or {"created": datetime.now().isoformat()},
+            "evicted": min(start, len(exchanges))
+        }
+        if data["exchanges"]:
+            data["metadata"]["last_updated"] = data["exchanges"][-1]["timestamp"]
+        if torn:
+            # Rewrite so the next append doesn't land after a partial line
+            self._save_conversation(model, data)
+        return data
+    
+    def _migrate_legacy_conversation(self, model: str) -> Dict:
+        """Convert a pre-log single-JSON conversation file, if one exists"""
+        legacy_path = self._get_conversation_file(model).with_suffix('.json')
+        
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {"exchanges": [], "metadata": {"created": datetime.now().isoformat()}}
         except (json.JSONDecodeError, IOError):
             # Corrupted file, start fresh
             return {"exchanges": [], "metadata": {"created": datetime.now().isoformat()}}
+        
+        # Legacy exchanges have no stored token counts; fill them before writing
+        for exchange in data["exchanges"]:
+            self.token_estimator.estimate_exchange_tokens(exchange, model)
+        self._save_conversation(model, data)
+        legacy_path.unlink()
+        return data
     
     def _save_conversation(self, model: str, data: Dict):
-        """Atomically save conversation to file"""
+        """Atomically rewrite the conversation log, dropping trimmed exchanges"""
         file_path = self._get_conversation_file(model)
         temp_path = file_path.with_suffix('.tmp')
         
         try:
-            # Write to temp file first
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            # Write to temp file first, coalescing lines into 64 KB writes
+            with open(temp_path, 'w', encoding='utf-8', buffering=65536) as f:
+                f.write(_json_line({"metadata": data["metadata"]}))
+                f.writelines(map(_exchange_line, data["exchanges"]))
+                # Make the contents durable before they replace the old log
+                f.flush()
+                os.fsync(f.fileno())
             
             # Atomic move
             temp_path.replace(file_path)
+            self._fsync_dir()
+            data["evicted"] = 0
             
         except Exception as e:
             # Clean up temp file if it exists
-            if temp_path.exists():
+            try:
                 temp_path.unlink()
+            except FileNotFoundError:
+                pass
             raise e
     
+    def _fsync_dir(self):
+        """Persist the directory entry after a rename (POSIX only)"""
+        if not hasattr(os, 'O_DIRECTORY'):
+            # Windows can't open directories; NTFS journals the rename
+            return
+        dir_fd = os.open(self.memory_dir, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    def _append_exchange(self, model: str, exchange: Dict, trimmed: int):
+        """Append one exchange, plus a trim marker if old exchanges were dropped"""
+        lines = _exchange_line(exchange)
+        if trimmed:
+            lines += _json_line({"trim": trimmed})
+        
+        # Single write so the exchange and its trim marker land together
+        with open(self._get_conversation_file(model), 'a', encoding='utf-8') as f:
+            f.write(lines)
+    
     def add_exchange(self, model: str, user_input: str, ai_response: str, context_window: int):
         """Add new conversation exchange and manage context window"""
         data = self._load_conversation(model)
+        now = datetime.now().isoformat()
         # Add new exchange using dataclass
         exchange = asdict(Exchange(
-            timestamp=datetime.now().isoformat(),
+            timestamp=now,
             user=user_input,
-            assistant=ai_response
+            assistant=ai_response,
+            tokens=self.token_estimator.estimate_tokens(user_input, model) + self.token_estimator.estimate_tokens(ai_response, model)
         ))
         data["exchanges"].append(exchange)
-        data["metadata"]["last_updated"] = datetime.now().isoformat()
+        data["total_tokens"] += exchange["tokens"]
+        data["metadata"]["last_updated"] = now
         # Trim to context window if needed
-        self._trim_to_context_window(data, context_window)
-        # Save updated conversation
-        self._save_conversation(model, data)
-    
-    def _trim_to_context_window(self, data: Dict, context_window: int):
-        """Keep conversation within token budget (optimized with per-exchange cache)"""
+        trimmed = self._trim_to_context_window(data, model, context_window)
+        
+        # "evicted" is absent until the conversation has a log on disk
+        evicted = data.get("evicted")
+        try:
+            if evicted is None or evicted + trimmed > len(data["exchanges"]):
+                # New conversation, or trimmed lines outnumber live ones: compact
+                self._save_conversation(model, data)
+            else:
+                self._append_exchange(model, exchange, trimmed)
+                data["evicted"] = evicted + trimmed
+        except Exception:
+            # The cached dict already holds this turn; drop it so the next load matches disk
+            self._cache.pop(model, None)
+            raise
+        # Our own write shouldn't invalidate the cache
+        data["file_state"] = self._file_state(model)
+    
+    def _trim_to_context_window(self, data: Dict, model: str, context_window: int) -> int:
+        """Keep conversation within token budget, returning how many exchanges were dropped"""
         exchanges = data["exchanges"]
-        if not exchanges:
-            return
-        if len(exchanges) <= 1:
-            return
-        # Cache token counts per exchange
-        token_counts = [self.token_estimator.estimate_tokens(e.get("user", "")) + self.token_estimator.estimate_tokens(e.get("assistant", "")) for e in exchanges]
-        while len(exchanges) > 1:
-            total_tokens = sum(token_counts)
-            if total_tokens <= context_window * 0.8:
-                break
-            exchanges.pop(0)
-            token_counts.pop(0)
-        data["exchanges"] = exchanges
+        budget = context_window * 0.8
+        # Nothing to drop while the running total fits; this only skips work
+        # until the history first fills, after which most appends overflow
+        if len(exchanges) <= 1 or data["total_tokens"] <= budget:
+            return 0
+        # Walk forward from the oldest exchange only as far as the overflow,
+        # always keeping the newest; token counts are cached on each exchange
+        total = data["total_tokens"]
+        cut = 0
+        while cut < len(exchanges) - 1 and total > budget:
+            total -= self.token_estimator.estimate_exchange_tokens(exchanges[cut], model)
+            cut += 1
+        del exchanges[:cut]
+        data["total_tokens"] = total
+        return cut
     
     def get_context_messages(self, model: str, current_input: str, context_window: int) -> List[Dict]:
         """Build context messages for API call"""
         data = self._load_conversation(model)
         exchanges = data["exchanges"]
         
-        messages = []
-        
-        # Add conversation history
-        for exchange in exchanges:
-            messages.append({"role": "user", "content": exchange["user"]})
-            messages.append({"role": "assistant", "content": exchange["assistant"]})
-        
-        return messages
+        # Walk back from the newest exchange until the budget left after the current input is spent
+        budget = context_window * 0.8 - self.token_estimator.estimate_tokens(current_input, model)
+        start = len(exchanges)
+        used = 0
+        for exchange in reversed(exchanges):
+            used += self.token_estimator.estimate_exchange_tokens(exchange, model)
+            if used > budget:
+                break
+            start -= 1
+        
+        # Add conversation history as alternating user/assistant messages
+        return [
+            message
+            for exchange in exchanges[start:]
+            for message in (
+                {"role": "user", "content": exchange["user"]},
+                {"role": "assistant", "content": exchange["assistant"]}
+            )
+        ]
     
     def get_stats(self, model: str) -> Dict:
         """Get conversation statistics"""
@@ -206,7 +384,7 @@ class MemoryManager:
         if not exchanges:
             return {"exchanges": 0, "tokens": 0, "created": "N/A"}
         
-        tokens = self.token_estimator.estimate_conversation_tokens(exchanges)
+        tokens = data["total_tokens"]
         created = data["metadata"].get("created", "Unknown")
         
         return {
@@ -217,9 +395,13 @@ class MemoryManager:
     
     def clear_conversation(self, model: str):
         """Clear conversation history for a model"""
+        self._cache.pop(model, None)
         file_path = self._get_conversation_file(model)
-        if file_path.exists():
-            file_path.unlink()
+        for path in (file_path, file_path.with_suffix('.json')):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
 
 
 class OllamaClient:
@@ -228,6 +410,9 @@ class OllamaClient:
     def __init__(self, base_url: str = "http://localhost:11434"):
         self.base_url = base_url
         self.session = requests.Session()
+        self._context_windows: Dict[str, int] = {}
+        # Tokens Ollama reported for the last chat_completion reply
+        self.last_eval_count: Optional[int] = None
     
     def is_available(self) -> bool:
         """Check if Ollama is running (with retry)"""
@@ -275,7 +460,14 @@ class OllamaClient:
 #     ...
     
     def detect_context_window(self, model: str) -> int:
-        """Detect context window size for model"""
+        """Detect context window size for model (cached per model)"""
+        context_window = self._context_windows.get(model)
+        if context_window is None:
+            context_window = self._context_windows[model] = self._guess_context_window(model)
+        return context_window
+    
+    def _guess_context_window(self, model: str) -> int:
+        """Guess context window size from the model name"""
         # Conservative defaults for common models
         model_lower = model.lower()
         
@@ -299,17 +491,17 @@ class OllamaClient:
         return min(context_window, 20000)
     
     def ensure_model_loaded(self, model: str) -> bool:
-        """Ensure model is loaded in Ollama by sending a test message"""
+        """Ensure model is loaded in Ollama without generating a reply"""
         try:
-            # Send a simple test message to warm up the model
+            # An empty prompt makes Ollama load the model and return without inference
             data = {
                 "model": model,
-                "messages": [{"role": "user", "content": "test"}],
+                "prompt": "",
                 "stream": False
             }
             
-            response = requests.post(
-                f"{self.base_url}/api/chat",
+            response = self.session.post(
+                f"{self.base_url}/api/generate",
                 json=data,
                 timeout=60  # Longer timeout for initial load
             )
@@ -321,6 +513,7 @@ class OllamaClient:
 
     def chat_completion(self, model: str, messages: List[Dict]) -> Optional[str]:
         """Get response from model with animated dots"""
+        self.last_eval_count = None
         try:
             # Prepare request
             data = {
@@ -329,16 +522,17 @@ class OllamaClient:
                 "stream": False
             }
             
-            # Show thinking dots
-            with ProgressDots():
-                response = requests.post(
-                    f"{self.base_url}/api/chat",
-                    json=data,
-                    timeout=120
-                )
+            # Show thinking dots while the request runs
+            response = ProgressDots().run(
+                self.session.post,
+                f"{self.base_url}/api/chat",
+                json=data,
+                timeout=120
+            )
             
             if response.status_code == 200:
                 result = response.json()
+                self.last_eval_count = result.get("eval_count")
                 return result.get("message", {}).get("content", "").strip()
             else:
                 return None
@@ -491,14 +685,21 @@ class MemAI:
             print("\nCannot connect to Ollama. Make sure it's running with: ollama serve")
             return
         
-        # Get available and loaded models
+        # Get available and loaded models, overlapping the two round-trips
+        loaded_models: List[str] = []
+        loaded_query = threading.Thread(
+            target=lambda: loaded_models.extend(self.ollama.get_loaded_models()),
+            daemon=True
+        )
+        loaded_query.start()
+        
         models = self.ollama.get_available_models()
         if not models:
             print("No models available")
             print("Install one with: ollama pull qwen2.5:3b")
             return
         
-        loaded_models = self.ollama.get_loaded_models()
+        loaded_query.join()
         
         # Always show model selection
         for i, model in enumerate(models, 1):
@@ -529,10 +730,9 @@ class MemAI:
         
         # Load the chosen model if not already loaded
         if self.current_model not in loaded_models:
-            with ProgressDots():
-                if not self.ollama.ensure_model_loaded(self.current_model):
-                    print("Failed to load model")
-                    return
+            if not ProgressDots().run(self.ollama.ensure_model_loaded, self.current_model):
+                print("Failed to load model")
+                return
         
         print()  # Add space after model selection
         
@@ -614,7 +814,11 @@ class MemAI:
         context_messages.append({"role": "user", "content": user_input})
         
         # Get response from model
-        return self.ollama.chat_completion(self.current_model, context_messages)
+        response = self.ollama.chat_completion(self.current_model, context_messages)
+        if response:
+            # Calibrate token estimates against Ollama's count for the reply
+            self.memory.token_estimator.calibrate(self.current_model, response, self.ollama.last_eval_count)
+        return response
     
     def _show_help(self):
         """Show available commands"""